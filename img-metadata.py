@@ -1,14 +1,49 @@
 import sys
 import os
 import json
-from PIL import Image, ImageCms, ImageStat
+import asyncio
+import hashlib
+from math import gcd
+import numpy as np
+from PIL import Image, ImageCms
 import imagehash
 import exifread
 from fastapi import FastAPI, File, UploadFile, HTTPException
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from io import BytesIO
-from collections import Counter
+from collections import OrderedDict
+from functools import lru_cache, partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# libjpeg-turbo's SIMD decoder straight into an ndarray; needs both PyTurboJPEG and
+# the native libturbojpeg, which TurboJPEG() fails to locate if it isn't installed
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB, TJFLAG_STOPONWARNING
+    turbojpeg = TurboJPEG()
+except (ImportError, RuntimeError, OSError):
+    turbojpeg = None
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+JPEG_DRAFT_SIZE = (256, 256)
+STAGE_WORKERS = 4
+RESULT_CACHE_SIZE = 1024
+
+# Optional output groups; format/size/filename/aspect ratio are always returned.
+# Only the pixel fields require decoding image data, the rest come from headers.
+PIXEL_FIELDS = ('dominant_colors', 'hashes', 'histogram', 'histogram_bins')
+FIELDS = ('icc_profile', 'exif', 'gps') + PIXEL_FIELDS
+
+# LRU of /extract responses keyed by (content digest, requested fields)
+result_cache = OrderedDict()
+
+# Shared by every request; one executor per process rather than per call
+stage_executor = ThreadPoolExecutor(max_workers=STAGE_WORKERS, thread_name_prefix="img-metadata")
 
 app = FastAPI(title="Image Metadata Extractor")
 
@@ -25,134 +60,371 @@ def extract_exif_with_exifread(image_file):
     tags = exifread.process_file(image_file, details=False)
     exif_data = {}
     gps_data = {}
-    for tag in tags.keys():
+    for tag, value in tags.items():
         clean_tag = str(tag)
         if clean_tag.startswith("GPS"):
-            gps_data[clean_tag] = str(tags[tag])
+            gps_data[clean_tag] = str(value)
         else:
-            exif_data[clean_tag] = str(tags[tag])
+            exif_data[clean_tag] = str(value)
     return exif_data, gps_data
 
-def extract_dominant_colors(image, num_colors=5):
-    small_image = image.resize((100, 100))
-    pixels = list(small_image.getdata())
-    counter = Counter(pixels)
-    most_common = counter.most_common(num_colors)
+def as_rgb(image):
+    # convert() copies the whole buffer even when the mode already matches; RGBA and
+    # other modes still go through convert(), which drops alpha for the RGB statistics
+    return image if image.mode == 'RGB' else image.convert('RGB')
+
+def extract_dominant_colors(small_image, num_colors=5):
+    arr = np.asarray(as_rgb(small_image), dtype=np.uint8).reshape(-1, 3)
+    # Pack each pixel into a single uint32 key so counting is one C-level unique
+    keys = (arr[:, 0].astype(np.uint32) << 16) | (arr[:, 1].astype(np.uint32) << 8) | arr[:, 2]
+    uniq, counts = np.unique(keys, return_counts=True)
+    # uniq is sorted by key, so the stable sort orders equal counts by color value
+    top = np.argsort(-counts, kind='stable')[:num_colors]
     color_info = []
-    for color, count in most_common:
-        hex_color = '#%02x%02x%02x' % color if isinstance(color, tuple) else str(color)
+    for key, count in zip(uniq[top].tolist(), counts[top].tolist()):
+        hex_color = '#%02x%02x%02x' % ((key >> 16) & 0xff, (key >> 8) & 0xff, key & 0xff)
         color_info.append({
             "color": hex_color,
             "count": count
         })
     return color_info
 
+# DCT-II basis for the 32x32 phash input, hoisted out of the request path. Scaled like
+# scipy.fftpack.dct (unnormalised) so hashes match imagehash.phash; only the
+# 8 low-frequency rows phash keeps are stored, so the transform is two small matmuls.
+_DCT_SIZE = 32
+_DCT_K = np.arange(_DCT_SIZE)
+_DCT_BASIS = np.ascontiguousarray(
+    2 * np.cos(np.pi * _DCT_K[:8, None] * (2 * _DCT_K[None, :] + 1) / (2 * _DCT_SIZE))
+)
+_DCT_BASIS_T = np.ascontiguousarray(_DCT_BASIS.T)
+
+def compute_hashes(rgb):
+    # Share one grayscale conversion across the hashes
+    gray = rgb.convert('L')
+    gray32 = np.asarray(gray.resize((32, 32), Image.LANCZOS), dtype=np.float64)
+
+    # Round off the ~1e-13 matmul noise so coefficients SciPy computes as exactly 0 stay 0;
+    # otherwise flat and gradient images flip bits against the median
+    dct_low = np.round(_DCT_BASIS @ gray32 @ _DCT_BASIS_T, 6)
+    phash = imagehash.ImageHash(dct_low > np.median(dct_low))
+
+    gray8 = np.asarray(gray.resize((8, 8), Image.LANCZOS))
+    ahash = imagehash.ImageHash(gray8 > gray8.mean())
+
+    gray9x8 = np.asarray(gray.resize((9, 8), Image.LANCZOS))
+    dhash = imagehash.ImageHash(gray9x8[:, 1:] > gray9x8[:, :-1])
+
+    return {
+        'perceptual_hash': str(phash),
+        'average_hash': str(ahash),
+        'difference_hash': str(dhash),
+        'wavelet_hash': str(imagehash.whash(gray)),
+    }
+
+def compute_histogram(rgb):
+    # A single C pass yields the R, G and B counts as three contiguous 256-bin rows;
+    # every statistic then follows from those counts (same definitions as PIL's
+    # ImageStat, without its pure-Python loops)
+    counts = np.asarray(rgb.histogram(), dtype=np.int64).reshape(3, 256)
+    levels = np.arange(256, dtype=np.int64)
+    n = counts.sum(axis=1)
+    total = (counts @ levels).astype(np.float64)
+    total2 = (counts @ (levels * levels)).astype(np.float64)
+    var = (total2 - total ** 2 / n) / n
+    median = (np.cumsum(counts, axis=1) > (n // 2)[:, None]).argmax(axis=1)
+    stats = {
+        'histogram_mean': (total / n).tolist(),
+        'histogram_median': median.tolist(),
+        'histogram_stddev': np.sqrt(np.maximum(var, 0)).tolist(),
+        'histogram_rms': np.sqrt(total2 / n).tolist(),
+    }
+    return stats, counts
+
 def calculate_aspect_ratio_and_mp(size):
     width, height = size
-    def gcd(a, b):
-        return a if b == 0 else gcd(b, a % b)
-    divisor = gcd(width, height)
+    divisor = gcd(width, height) or 1
     aspect_ratio = f"{width // divisor}:{height // divisor}"
     megapixels = round((width * height) / 1_000_000, 2)
     return aspect_ratio, megapixels
 
-def extract_metadata(image_file):
-    metadata = {}
-    image = Image.open(image_file)
+# Pipeline stages. Each takes the per-request context dict: the prepare stages
+# (header, decode) fill it in, the extract stages return their slice of the metadata.
+
+def stage_header(ctx):
+    image, image_file, metadata = ctx['image'], ctx['file'], ctx['metadata']
     metadata['format'] = image.format
     metadata['mode'] = image.mode
     metadata['size'] = image.size
-    metadata['filename'] = getattr(image_file, 'name', 'unknown')
+    metadata['filename'] = getattr(image_file, 'name', None) or 'unknown'
 
-    # File size detection
+    # File size detection (seek/tell first: fileno() forces a SpooledTemporaryFile to disk)
     try:
-        if hasattr(image_file, 'fileno'):
-            metadata['file_size_bytes'] = os.fstat(image_file.fileno()).st_size
-        else:
+        if hasattr(image_file, 'seek'):
             current_pos = image_file.tell()
             image_file.seek(0, os.SEEK_END)
             size = image_file.tell()
             image_file.seek(current_pos, os.SEEK_SET)
             metadata['file_size_bytes'] = size
-    except Exception:
+        else:
+            metadata['file_size_bytes'] = os.fstat(image_file.fileno()).st_size
+    except (OSError, ValueError):
         metadata['file_size_bytes'] = None
 
-    # ICC Profile
-    icc_profile = image.info.get('icc_profile')
-    if icc_profile:
-        try:
-            profile = ImageCms.getOpenProfile(BytesIO(icc_profile))
-            desc = profile.profile.product_desc.decode('utf-8', errors='ignore').strip()
-            metadata['icc_profile'] = desc if desc else "ICC profile embedded but no description provided."
-        except:
-            metadata['icc_profile'] = "Embedded ICC profile detected but unreadable. Likely sRGB or camera-specific."
-    else:
-        metadata['icc_profile'] = "No ICC profile embedded."
-
     # Aspect ratio and megapixels
     aspect_ratio, megapixels = calculate_aspect_ratio_and_mp(image.size)
     metadata['aspect_ratio'] = aspect_ratio
     metadata['megapixels'] = megapixels
 
-    # Dominant Colors
+def decode_rgb(image):
+    # A failed decode returns None and each pixel stage reports its own failure
     try:
-        metadata['dominant_colors'] = extract_dominant_colors(image, num_colors=5)
-    except:
-        metadata['dominant_colors'] = "Unable to extract dominant colors."
+        rgb = as_rgb(image)
+        rgb.load()
+    except OSError:
+        return None
+    return rgb
+
+def stage_decode(ctx, targets):
+    # Decode once, before fanning out, so exifread has the stream to itself and the
+    # pixel stages only read shared, already loaded RGB buffers
+    rgb = decode_rgb(ctx['image'])
+    for target in targets:
+        ctx[target] = rgb
+
+def stage_decode_draft(ctx):
+    # Hashes and colors always come from a 1/2-1/8 scale libjpeg decode, so their
+    # values don't depend on which other fields were requested; a separate handle
+    # keeps ctx['image'] at full resolution for the histogram stages
+    image_file = ctx['file']
+    image_file.seek(0)
+    thumb = Image.open(image_file)
+    thumb.draft('RGB', JPEG_DRAFT_SIZE)
+    ctx['thumb'] = decode_rgb(thumb)
 
-    # EXIF and GPS via exifread
+def stage_decode_turbojpeg(ctx, draft):
+    # Decode the JPEG bytes with libjpeg-turbo, scaling by 1/2-1/8 in the IDCT the same
+    # way draft() would; PIL only wraps the resulting array for the pixel stages
+    image, image_file = ctx['image'], ctx['file']
+    scaling_factor = None
+    if draft:
+        scale = min(image.size[0] // JPEG_DRAFT_SIZE[0], image.size[1] // JPEG_DRAFT_SIZE[1])
+        # Same choice as PIL's draft(): images smaller than JPEG_DRAFT_SIZE stay at 1/1
+        denominator = next((d for d in (8, 4, 2) if scale >= d), 1)
+        scaling_factor = (1, denominator) if denominator > 1 else None
     try:
         image_file.seek(0)
-        exif_data, gps_data = extract_exif_with_exifread(image_file)
-        metadata['exif'] = exif_data if exif_data else "No EXIF data found."
-        metadata['gps'] = gps_data if gps_data else "No GPS data found."
+        # PyTurboJPEG only warns on recoverable errors (e.g. a truncated file) and returns
+        # the partly decoded pixels; make those raise so they take the PIL path below
+        pixels = turbojpeg.decode(image_file.read(), pixel_format=TJPF_RGB,
+                                  scaling_factor=scaling_factor, flags=TJFLAG_STOPONWARNING)
+    except OSError:
+        return stage_decode_draft(ctx) if draft else stage_decode(ctx, ('rgb',))
+    ctx['thumb' if draft else 'rgb'] = Image.fromarray(pixels)
+
+def stage_icc(ctx):
+    icc_profile = ctx['image'].info.get('icc_profile')
+    if not icc_profile:
+        return {'icc_profile': "No ICC profile embedded."}
+    try:
+        profile = ImageCms.getOpenProfile(BytesIO(icc_profile))
+        desc = ImageCms.getProfileDescription(profile).strip()
+    except (ImageCms.PyCMSError, OSError):
+        return {'icc_profile': "Embedded ICC profile detected but unreadable. Likely sRGB or camera-specific."}
+    return {'icc_profile': desc if desc else "ICC profile embedded but no description provided."}
+
+def decoded_rgb(ctx, key='rgb'):
+    # The decode stages leave None when the pixel data couldn't be decoded
+    if ctx[key] is None:
+        raise OSError("Image data could not be decoded.")
+    return ctx[key]
+
+def stage_exif(ctx, keys):
+    # exifread only walks the metadata segments of the file, never the pixel data
+    try:
+        exif_data, gps_data = extract_exif_with_exifread(ctx['file'])
+        result = {
+            'exif': exif_data if exif_data else "No EXIF data found.",
+            'gps': gps_data if gps_data else "No GPS data found.",
+        }
     except Exception as e:
-        metadata['exif'] = f"Error extracting EXIF: {str(e)}"
-        metadata['gps'] = "No GPS data found."
+        result = {
+            'exif': f"Error extracting EXIF: {str(e)}",
+            'gps': "No GPS data found.",
+        }
+    return {key: result[key] for key in keys}
 
-    # Hashes
+def stage_colors(ctx):
     try:
-        metadata['perceptual_hash'] = str(imagehash.phash(image))
-        metadata['average_hash'] = str(imagehash.average_hash(image))
-        metadata['difference_hash'] = str(imagehash.dhash(image))
-        metadata['wavelet_hash'] = str(imagehash.whash(image))
-    except:
-        metadata['hashes'] = "Unable to compute hashes."
-
-    # Histogram and RMS
+        small = decoded_rgb(ctx, 'thumb').resize((100, 100), Image.Resampling.BOX)
+        return {'dominant_colors': extract_dominant_colors(small, num_colors=5)}
+    except (OSError, ValueError):
+        return {'dominant_colors': "Unable to extract dominant colors."}
+
+def stage_hashes(ctx):
     try:
-        stat = ImageStat.Stat(image.convert('RGB'))
-        metadata['histogram_mean'] = stat.mean
-        metadata['histogram_median'] = stat.median
-        metadata['histogram_stddev'] = stat.stddev
-        metadata['histogram_rms'] = stat.rms
-        histogram_bins = image.convert('RGB').histogram()
-        metadata['histogram_bins'] = histogram_bins
-    except:
-        metadata['histogram'] = "Unable to compute histogram."
+        return compute_hashes(decoded_rgb(ctx, 'thumb'))
+    except (OSError, ValueError):
+        return {'hashes': "Unable to compute hashes."}
+
+def stage_stats(ctx, stats, bins):
+    try:
+        summary, counts = compute_histogram(decoded_rgb(ctx))
+        result = summary if stats else {}
+        if bins:
+            result['histogram_bins'] = counts.ravel().tolist()
+        return result
+    except (OSError, ValueError):
+        return {'histogram': "Unable to compute histogram."}
+
+@lru_cache(maxsize=None)
+def compile_pipeline(image_format, image_mode, fields):
+    # Resolve every per-field, per-format and per-mode branch once for each combination;
+    # requests then just run the resulting stage tuples
+    prepare = [stage_header]
+    # Each pixel feature uses one fixed resolution: hashes and colors the draft-scale
+    # "thumb", histogram statistics and bins the full-resolution "rgb"
+    thumb_needed = 'dominant_colors' in fields or 'hashes' in fields
+    full_needed = 'histogram' in fields or 'histogram_bins' in fields
+    # Pillow opens JPEGs with an MP Format segment (most camera and phone photos) as MPO;
+    # its first frame is a plain JPEG and draft() works the same
+    if image_format in ('JPEG', 'MPO'):
+        # libjpeg-turbo can't produce RGB from CMYK/YCCK JPEGs; those stay on PIL
+        turbo = image_mode in ('RGB', 'L') and turbojpeg is not None
+        if thumb_needed:
+            prepare.append(partial(stage_decode_turbojpeg, draft=True) if turbo else stage_decode_draft)
+        if full_needed:
+            prepare.append(partial(stage_decode_turbojpeg, draft=False) if turbo else partial(stage_decode, targets=('rgb',)))
+    else:
+        # Other formats have no reduced-scale decode, so one full decode serves both
+        targets = (('thumb',) if thumb_needed else ()) + (('rgb',) if full_needed else ())
+        if targets:
+            prepare.append(partial(stage_decode, targets=targets))
+
+    extract = []
+    if 'icc_profile' in fields:
+        extract.append(stage_icc)
+    exif_keys = tuple(key for key in ('exif', 'gps') if key in fields)
+    if exif_keys:
+        extract.append(partial(stage_exif, keys=exif_keys))
+    if 'dominant_colors' in fields:
+        extract.append(stage_colors)
+    if 'hashes' in fields:
+        extract.append(stage_hashes)
+    if 'histogram' in fields or 'histogram_bins' in fields:
+        extract.append(partial(stage_stats, stats='histogram' in fields, bins='histogram_bins' in fields))
+    return tuple(prepare), tuple(extract)
+
+def extract_metadata(image_file, fields=FIELDS):
+    # PIL and exifread both need to seek; buffer streams that can't
+    if not (hasattr(image_file, 'seekable') and image_file.seekable()):
+        image_file = BytesIO(image_file.read())
+    image = Image.open(image_file)
+    ctx = {'file': image_file, 'image': image, 'thumb': None, 'rgb': None, 'metadata': {}}
+    prepare, extract = compile_pipeline(image.format, image.mode, frozenset(fields))
+    for stage in prepare:
+        stage(ctx)
 
+    # The extract stages are independent; PIL and NumPy release the GIL in their C loops
+    futures = [stage_executor.submit(stage, ctx) for stage in extract]
+    metadata = ctx['metadata']
+    for future in futures:
+        metadata.update(future.result())
     return metadata
 
+def extract_metadata_from_bytes(contents, fields=FIELDS):
+    # Entry point for the process pool: file objects don't pickle, bytes do
+    return extract_metadata(BytesIO(contents), fields)
+
+def extract_metadata_from_path(image_path, fields=FIELDS):
+    # One fstat-sized read of the whole file instead of the many small reads PIL and
+    # exifread issue while streaming from a buffered file
+    with open(image_path, 'rb', buffering=0) as f:
+        image_file = BytesIO(f.read())
+    image_file.name = image_path
+    return extract_metadata(image_file, fields)
+
+def init_worker():
+    # Parallelism comes from the worker processes themselves; one stage thread per
+    # worker keeps cpu_count() workers from oversubscribing the CPUs
+    global stage_executor
+    stage_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="img-metadata")
+    # Register every PIL plugin up front so a worker's first request doesn't pay for it
+    Image.init()
+
+def create_worker_pool():
+    return ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=init_worker)
+
+def extract_many(image_paths, fields=FIELDS):
+    # Batch ingestion: each worker process reads and decodes its own files in parallel
+    with create_worker_pool() as pool:
+        results = pool.map(extract_metadata_from_path, image_paths, [fields] * len(image_paths))
+        return dict(zip(image_paths, results))
+
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python img-metadata.py <image_path>")
-        sys.exit(1)
-    image_path = sys.argv[1]
-    if not os.path.exists(image_path):
-        print(f"File {image_path} does not exist.")
+    if len(sys.argv) < 2:
+        print("Usage: python img-metadata.py <image_path> [<image_path> ...]")
         sys.exit(1)
-    with open(image_path, 'rb') as f:
-        metadata = extract_metadata(f)
+    image_paths = sys.argv[1:]
+    for image_path in image_paths:
+        if not os.path.exists(image_path):
+            print(f"File {image_path} does not exist.")
+            sys.exit(1)
+    if len(image_paths) == 1:
+        metadata = extract_metadata_from_path(image_paths[0])
+    else:
+        metadata = extract_many(image_paths)
     print(json.dumps(metadata, indent=4))
 
+def content_digest(contents):
+    # blake3 is SIMD-accelerated; blake2b from hashlib is the stdlib fallback
+    if blake3 is not None:
+        return blake3.blake3(contents).hexdigest()
+    return hashlib.blake2b(contents).hexdigest()
+
+@app.on_event("startup")
+def start_worker_pool():
+    app.state.pool = create_worker_pool()
+
+@app.on_event("shutdown")
+def stop_worker_pool():
+    app.state.pool.shutdown()
+
 @app.get("/health")
 def health_check():
     return {"status": "ok"}
 
 @app.post("/extract")
-async def extract(file: UploadFile = File(...)):
+async def extract(file: UploadFile = File(...), fields: str | None = None):
     if not file.filename.lower().endswith((".jpg", ".jpeg", ".png", ".webp", ".tiff")):
         raise HTTPException(status_code=400, detail="Unsupported file type.")
+    requested = FIELDS if fields is None else tuple(f.strip() for f in fields.split(',') if f.strip())
+    unknown = set(requested) - set(FIELDS)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}.")
     contents = await file.read()
-    metadata = extract_metadata(BytesIO(contents))
+    loop = asyncio.get_running_loop()
+
+    # Identical uploads (same bytes, same fields) are answered from the cache without
+    # decoding. Only this coroutine touches result_cache, so it needs no lock.
+    key = (await loop.run_in_executor(None, content_digest, contents), frozenset(requested))
+    metadata = result_cache.get(key)
+    if metadata is not None:
+        result_cache.move_to_end(key)
+        return JSONResponse(content=metadata)
+
+    # Decode in a worker process so requests use every CPU instead of sharing one GIL
+    pool = app.state.pool
+    try:
+        metadata = await loop.run_in_executor(pool, extract_metadata_from_bytes, contents, requested)
+    except BrokenProcessPool:
+        # A worker died (e.g. OOM-killed mid-decode); replace the pool once so later
+        # requests don't keep failing, even if several requests saw it break
+        if app.state.pool is pool:
+            app.state.pool = create_worker_pool()
+            pool.shutdown(wait=False)
+        raise HTTPException(status_code=500, detail="Image worker crashed while processing this file.")
+    result_cache[key] = metadata
+    if len(result_cache) > RESULT_CACHE_SIZE:
+        result_cache.popitem(last=False)
     return JSONResponse(content=metadata)
@@ -0,0 +1,288 @@
+import importlib.util
+import io
+import os
+import sys
+import warnings
+
+import imagehash
+import numpy as np
+import pytest
+from PIL import Image
+
+# img-metadata.py isn't importable by name (hyphen), so load it from its path
+_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'img-metadata.py')
+_spec = importlib.util.spec_from_file_location('img-metadata', _PATH)
+m = importlib.util.module_from_spec(_spec)
+sys.modules['img-metadata'] = m
+_spec.loader.exec_module(m)
+
+
+def test_dominant_colors_ties_ordered_by_value():
+    # 10 000 distinct colors, all with count 1: the lowest keys must win
+    keys = np.random.default_rng(0).permutation(10_000).astype(np.uint32)
+    arr = np.stack([(keys >> 16) & 0xff, (keys >> 8) & 0xff, keys & 0xff], axis=-1)
+    image = Image.fromarray(arr.astype(np.uint8).reshape(100, 100, 3))
+    colors = m.extract_dominant_colors(image, num_colors=5)
+    assert [c['color'] for c in colors] == ['#000000', '#000001', '#000002', '#000003', '#000004']
+
+
+def test_dominant_colors_most_common_first():
+    arr = np.zeros((100, 100, 3), dtype=np.uint8)
+    arr[:60] = (255, 0, 0)
+    arr[60:90] = (0, 255, 0)
+    colors = m.extract_dominant_colors(Image.fromarray(arr), num_colors=5)
+    assert colors == [
+        {'color': '#ff0000', 'count': 6000},
+        {'color': '#00ff00', 'count': 3000},
+        {'color': '#000000', 'count': 1000},
+    ]
+
+
+def _smooth_images(count):
+    rng = np.random.default_rng(1)
+    y, x = np.mgrid[0:120, 0:160]
+    for _ in range(count):
+        fx, fy, phase = rng.uniform(0.005, 0.08, 2).tolist() + [rng.uniform(0, 6.3)]
+        channels = [np.sin(x * fx + phase + c) + np.cos(y * fy - c) for c in range(3)]
+        arr = (np.stack(channels, axis=-1) * 63 + 128).clip(0, 255).astype(np.uint8)
+        yield Image.fromarray(arr)
+
+
+def test_average_and_difference_hash_match_imagehash():
+    for image in _smooth_images(50):
+        hashes = m.compute_hashes(image)
+        assert hashes['average_hash'] == str(imagehash.average_hash(image))
+        assert hashes['difference_hash'] == str(imagehash.dhash(image))
+
+
+def _photo_jpeg(path, size=(1600, 1200)):
+    y, x = np.mgrid[0:size[1], 0:size[0]]
+    arr = np.stack([x * 255 // size[0], y * 255 // size[1], (x + y) % 256], axis=-1).astype(np.uint8)
+    Image.fromarray(arr).save(path, quality=90)
+    return path
+
+
+def _photo_mpo(path, size=(1600, 1200)):
+    # A JPEG carrying an MP Format segment, as cameras and phones write them
+    photo = Image.open(_photo_jpeg(path, size))
+    photo.load()
+    photo.save(path, format='MPO', save_all=True, append_images=[photo.resize((160, 120))])
+    return path
+
+
+@pytest.mark.parametrize('make_photo', [_photo_jpeg, _photo_mpo])
+def test_pixel_fields_do_not_depend_on_other_requested_fields(tmp_path, make_photo):
+    path = make_photo(tmp_path / 'photo.jpg')
+    everything = m.extract_metadata_from_path(str(path))
+    hashes_only = m.extract_metadata_from_path(str(path), ('hashes',))
+    colors_only = m.extract_metadata_from_path(str(path), ('dominant_colors',))
+    stats_only = m.extract_metadata_from_path(str(path), ('histogram',))
+    for key in ('perceptual_hash', 'average_hash', 'difference_hash', 'wavelet_hash'):
+        assert hashes_only[key] == everything[key]
+    assert colors_only['dominant_colors'] == everything['dominant_colors']
+    assert stats_only['histogram_mean'] == everything['histogram_mean']
+    assert 'histogram_bins' not in stats_only
+    # Hashes come from the draft-scale decode for MPO files too
+    thumb = Image.open(path)
+    thumb.draft('RGB', m.JPEG_DRAFT_SIZE)
+    assert m.compute_hashes(thumb.convert('RGB'))['perceptual_hash'] == everything['perceptual_hash']
+
+
+def test_extract_replaces_broken_worker_pool(tmp_path):
+    import signal
+    from fastapi.testclient import TestClient
+
+    path = _photo_jpeg(tmp_path / 'photo.jpg', size=(320, 240))
+    with TestClient(m.app) as client:
+        broken = m.app.state.pool
+        # Kill a live worker to simulate an OOM kill; the pool breaks on the next submit
+        broken.submit(os.getpid).result()
+        os.kill(next(iter(broken._processes)), signal.SIGKILL)
+        with open(path, 'rb') as f:
+            response = client.post('/extract?fields=hashes', files={'file': ('photo.jpg', f)})
+        assert response.status_code == 500
+        assert m.app.state.pool is not broken
+
+        m.result_cache.clear()
+        with open(path, 'rb') as f:
+            response = client.post('/extract?fields=hashes', files={'file': ('photo.jpg', f)})
+        assert response.status_code == 200
+        assert 'perceptual_hash' in response.json()
+
+
+_TJFLAG_STOPONWARNING = 8192
+
+
+class _UnusablePool:
+    # Swapped in for app.state.pool to prove a request never reached the workers
+    def submit(self, *args, **kwargs):
+        raise AssertionError("request was sent to the worker pool")
+
+
+@pytest.fixture
+def client():
+    from fastapi.testclient import TestClient
+
+    m.result_cache.clear()
+    with TestClient(m.app) as client:
+        yield client
+    m.result_cache.clear()
+
+
+def _post(client, path, fields=None):
+    url = '/extract' if fields is None else f'/extract?fields={fields}'
+    with open(path, 'rb') as f:
+        return client.post(url, files={'file': ('photo.jpg', f)})
+
+
+def test_extract_answers_repeat_uploads_from_cache(tmp_path, client, monkeypatch):
+    path = _photo_jpeg(tmp_path / 'photo.jpg', size=(320, 240))
+    first = _post(client, path, 'hashes,histogram')
+    assert first.status_code == 200
+
+    monkeypatch.setattr(m.app.state, 'pool', _UnusablePool())
+    # Same bytes and the same set of fields, in any order, is a hit
+    repeat = _post(client, path, 'histogram,hashes')
+    assert repeat.status_code == 200
+    assert repeat.json() == first.json()
+
+    # Different fields are a miss and go to the workers
+    with pytest.raises(AssertionError):
+        _post(client, path, 'hashes')
+
+
+def test_extract_cache_evicts_least_recently_used(tmp_path, client, monkeypatch):
+    monkeypatch.setattr(m, 'RESULT_CACHE_SIZE', 2)
+    paths = [_photo_jpeg(tmp_path / f'photo{i}.jpg', size=(64 + i, 48)) for i in range(3)]
+    for path in paths[:2]:
+        _post(client, path, 'hashes')
+    # Touch the oldest entry so the second upload becomes the eviction candidate
+    _post(client, paths[0], 'hashes')
+    _post(client, paths[2], 'hashes')
+
+    digests = [key[0] for key in m.result_cache]
+    assert len(m.result_cache) == 2
+    assert digests == [m.content_digest(paths[i].read_bytes()) for i in (0, 2)]
+
+
+_HEADER_KEYS = {'format', 'mode', 'size', 'filename', 'file_size_bytes', 'aspect_ratio', 'megapixels'}
+_PIXEL_KEYS = {'dominant_colors', 'perceptual_hash', 'average_hash', 'difference_hash', 'wavelet_hash',
+               'hashes', 'histogram_mean', 'histogram_median', 'histogram_stddev', 'histogram_rms',
+               'histogram', 'histogram_bins'}
+
+
+def test_extract_fields_selects_header_only_groups(tmp_path, client):
+    path = _photo_jpeg(tmp_path / 'photo.jpg', size=(320, 240))
+    response = _post(client, path, 'exif,gps')
+    assert response.status_code == 200
+    assert set(response.json()) == _HEADER_KEYS | {'exif', 'gps'}
+    assert not set(response.json()) & _PIXEL_KEYS
+
+
+def test_extract_empty_fields_returns_only_header_keys(tmp_path, client):
+    path = _photo_jpeg(tmp_path / 'photo.jpg', size=(320, 240))
+    response = _post(client, path, '')
+    assert response.status_code == 200
+    assert set(response.json()) == _HEADER_KEYS
+
+
+def test_extract_rejects_unknown_fields(tmp_path, client):
+    path = _photo_jpeg(tmp_path / 'photo.jpg', size=(320, 240))
+    response = _post(client, path, 'hashes,thumbnail,bogus')
+    assert response.status_code == 400
+    assert response.json()['detail'] == "Unknown fields: bogus, thumbnail."
+
+
+class _StubTurboJPEG:
+    # Stands in for PyTurboJPEG without the native library: decodes with PIL, honouring
+    # scaling_factor through draft() so the pipeline sees the same reduced image. Like
+    # libjpeg-turbo, a truncated file only warns and returns gray-padded pixels unless
+    # TJFLAG_STOPONWARNING is set.
+    def __init__(self):
+        self.scaling_factors = []
+
+    def decode(self, jpeg_buf, pixel_format=None, scaling_factor=None, flags=0):
+        self.scaling_factors.append(scaling_factor)
+        image = Image.open(io.BytesIO(jpeg_buf))
+        if scaling_factor is not None:
+            num, den = scaling_factor
+            image.draft('RGB', (image.size[0] * num // den, image.size[1] * num // den))
+        try:
+            return np.asarray(image.convert('RGB'))
+        except OSError:
+            if flags & _TJFLAG_STOPONWARNING:
+                raise OSError("Premature end of JPEG file")
+            warnings.warn("Premature end of JPEG file")
+            return np.full((image.size[1], image.size[0], 3), 128, dtype=np.uint8)
+
+
+@pytest.fixture
+def stub_turbojpeg(monkeypatch):
+    stub = _StubTurboJPEG()
+    monkeypatch.setattr(m, 'turbojpeg', stub)
+    monkeypatch.setattr(m, 'TJPF_RGB', 0, raising=False)
+    monkeypatch.setattr(m, 'TJFLAG_STOPONWARNING', _TJFLAG_STOPONWARNING, raising=False)
+    m.compile_pipeline.cache_clear()
+    yield stub
+    m.compile_pipeline.cache_clear()
+
+
+@pytest.mark.parametrize('size, scaling_factor', [
+    ((70, 50), None),
+    ((300, 200), None),
+    ((1600, 1200), (1, 4)),
+    ((4000, 3000), (1, 8)),
+])
+def test_turbojpeg_draft_scaling(tmp_path, stub_turbojpeg, size, scaling_factor):
+    path = _photo_jpeg(tmp_path / 'photo.jpg', size=size)
+    metadata = m.extract_metadata_from_path(str(path), ('hashes', 'histogram'))
+    assert 'perceptual_hash' in metadata
+    assert 'histogram_mean' in metadata
+    # draft decode for the hashes, full decode for the statistics
+    assert stub_turbojpeg.scaling_factors == [scaling_factor, None]
+
+
+def test_turbojpeg_path_matches_pil_path(tmp_path, stub_turbojpeg):
+    path = _photo_jpeg(tmp_path / 'photo.jpg')
+    with_turbojpeg = m.extract_metadata_from_path(str(path))
+    m.turbojpeg = None
+    m.compile_pipeline.cache_clear()
+    assert m.extract_metadata_from_path(str(path)) == with_turbojpeg
+
+
+def _flat_and_gradient_images():
+    ramp = np.tile(np.linspace(0, 255, 64).astype(np.uint8), (64, 1))
+    return [
+        Image.new('RGB', (64, 64)),
+        Image.new('RGB', (64, 64), (128, 128, 128)),
+        Image.new('RGB', (64, 64), (200, 30, 30)),
+        Image.fromarray(ramp).convert('RGB'),
+        Image.fromarray(ramp.T.copy()).convert('RGB'),
+    ]
+
+
+def test_perceptual_hash_matches_imagehash():
+    images = _flat_and_gradient_images() + list(_smooth_images(8))
+    for image in images:
+        assert m.compute_hashes(image)['perceptual_hash'] == str(imagehash.phash(image))
+
+
+def test_perceptual_hash_of_flat_and_gradient_images():
+    # Only the DC term is non-zero, so it alone sits above the median
+    black, grey = _flat_and_gradient_images()[:2]
+    assert m.compute_hashes(black)['perceptual_hash'] == '0000000000000000'
+    assert m.compute_hashes(grey)['perceptual_hash'] == '8000000000000000'
+
+
+def test_turbojpeg_truncated_file_falls_back_to_pil(tmp_path, stub_turbojpeg):
+    path = _photo_jpeg(tmp_path / 'photo.jpg')
+    truncated = tmp_path / 'truncated.jpg'
+    truncated.write_bytes(path.read_bytes()[:60000])
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        with_turbojpeg = m.extract_metadata_from_path(str(truncated))
+    m.turbojpeg = None
+    m.compile_pipeline.cache_clear()
+    assert m.extract_metadata_from_path(str(truncated)) == with_turbojpeg
+    assert with_turbojpeg['hashes'] == "Unable to compute hashes."
+    assert with_turbojpeg['histogram'] == "Unable to compute histogram."